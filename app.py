@@ -33,6 +33,12 @@ import matplotlib.patches as mpatches
 import socket
 import webbrowser
 import threading
+import sqlite3
+import hashlib
+import json
+from contextlib import closing
+from datetime import datetime
+from packaging.version import Version
 
 # 设置页面配置
 st.set_page_config(
@@ -90,101 +96,500 @@ def validate_data(df):
     
     return errors, warnings
 
-def calculate_boundary_lines(x_range, slope, intercept, y_threshold, slope_change_ratio):
-    """计算上边界线（当y值超过阈值时改变斜率）"""
-    x_vals = []
-    y_vals = []
-    
-    for x in x_range:
-        y = slope * x + intercept
-        if y > y_threshold:
-            # 使用新斜率
-            new_slope = slope * slope_change_ratio
-            # 计算新截距，使得在阈值点连续
-            x_threshold = (y_threshold - intercept) / slope
-            new_intercept = y_threshold - new_slope * x_threshold
-            y = new_slope * x + new_intercept
-        x_vals.append(x)
-        y_vals.append(y)
-    
-    return x_vals, y_vals
+# 计算映射结果时追加到会话数据中的列
+COMPUTED_COLUMNS = ['映射结果', '距上边界', '距下边界', '距标准线']
 
-def calculate_lower_boundary_lines(x_range, slope, intercept, y_threshold, slope_change_ratio):
-    """计算下边界线（当y值低于阈值时改变斜率）"""
-    x_vals = []
-    y_vals = []
-    
-    for x in x_range:
-        y = slope * x + intercept
-        if y < y_threshold:
-            # 使用新斜率
-            new_slope = slope * slope_change_ratio
-            # 计算新截距，使得在阈值点连续
-            x_threshold = (y_threshold - intercept) / slope
-            new_intercept = y_threshold - new_slope * x_threshold
-            y = new_slope * x + new_intercept
-        x_vals.append(x)
-        y_vals.append(y)
-    
-    return x_vals, y_vals
+# 映射结果的全部取值
+REGION_LABELS = ["超额支付", "合理区间", "价值低估", "数据错误"]
 
-def classify_city_region(x, y, config):
-    """判断城市在图表中的映射结果"""
-    # 确保x和y是数值类型
-    try:
-        x = float(x)
-        y = float(y)
-    except (ValueError, TypeError):
-        return "数据错误"
-    # 基准点和标准线
-    point1 = (config['point1_x'], config['point1_y'])
-    point2 = (config['point2_x'], config['point2_y'])
-    
+# 影响映射结果的配置参数（另有上下边界的拐点列表，见 get_boundary_knees）
+CLASSIFICATION_CONFIG_KEYS = ('point1_x', 'point1_y', 'point2_x', 'point2_y', 'float_ratio')
+
+def compact_city_data(df, use_float32=False):
+    """将数据整理为会话中唯一保存的紧凑列式数据
+
+    城市使用 category 类型；人效、CR值、离职率转换为数值类型（可选 float32），
+    包含非数值数据的列保持原样，以便 validate_data 报告错误。
+    旧的映射结果列会被移除，需要重新计算。
+    """
+    df = df.drop(columns=[col for col in COMPUTED_COLUMNS if col in df.columns])
+
+    if '城市' in df.columns:
+        df['城市'] = df['城市'].astype('category')
+
+    for col in ['人效', 'CR值', '离职率']:
+        if col not in df.columns:
+            continue
+        try:
+            values = pd.to_numeric(df[col], errors='raise')
+        except (ValueError, TypeError):
+            continue
+        df[col] = values.astype(np.float32 if use_float32 else np.float64)
+
+    return df
+
+def set_numeric_precision(df, use_float32):
+    """切换会话数据中数值列和距离列的存储精度（原地修改），映射结果保持不变"""
+    dtype = np.float32 if use_float32 else np.float64
+    for col in ['人效', 'CR值', '离职率', '距上边界', '距下边界', '距标准线']:
+        if col in df.columns and pd.api.types.is_float_dtype(df[col]):
+            df[col] = df[col].astype(dtype)
+    return df
+
+def editor_view(df):
+    """生成数据编辑器的输入：不含映射结果列，城市列转为文本以便新增城市"""
+    view = df.drop(columns=[col for col in COMPUTED_COLUMNS if col in df.columns])
+    if '城市' in view.columns and isinstance(view['城市'].dtype, pd.CategoricalDtype):
+        view['城市'] = view['城市'].astype(str)
+    return view
+
+def estimate_session_memory(session_state):
+    """统计会话中保存的DataFrame和缓存的图表PNG占用的内存（字节）
+
+    Figure 对象本身的内存难以准确统计，不计入。
+    """
+    total = 0
+    for value in session_state.values():
+        if isinstance(value, pd.DataFrame):
+            total += value.memory_usage(deep=True).sum()
+        elif isinstance(getattr(value, 'png_cache', None), dict):
+            # 每次刷新都会重新执行脚本、重新定义类，因此按属性识别图表渲染器
+            total += sum(len(png) for png in value.png_cache.values())
+    return total
+
+def format_memory_size(num_bytes):
+    """将字节数格式化为易读的大小"""
+    for unit in ['B', 'KB', 'MB']:
+        if num_bytes < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GB"
+
+def get_boundary_knees(config, side):
+    """读取上边界（side='upper'）或下边界（side='lower'）的拐点列表
+
+    每个拐点为 (Y轴阈值, 斜率变化比例)：上边界线的y值超过阈值后、下边界线的y值低于阈值后，
+    斜率变为标准线斜率乘以该比例。兼容只有单个阈值的旧配置。
+    """
+    if f'{side}_knees' in config:
+        knees = config[f'{side}_knees']
+    else:
+        knees = [(config[f'{side}_y_threshold'], config[f'{side}_slope_ratio'])]
+    # 上边界按阈值从低到高、下边界按阈值从高到低依次生效
+    return sorted(((float(t), float(r)) for t, r in knees), reverse=(side == 'lower'))
+
+def parse_boundary_knees(df):
+    """将侧边栏拐点表格转换为 ((Y轴阈值, 斜率变化比例), ...)，忽略未填写完整的行"""
+    df = df.apply(pd.to_numeric, errors='coerce').dropna()
+    return tuple((float(t), float(r)) for t, r in df[['Y轴阈值', '斜率变化比例']].itertuples(index=False))
+
+def classification_config(config):
+    """提取影响映射结果的配置，用于判断配置是否变化"""
+    result = {key: float(config[key]) for key in CLASSIFICATION_CONFIG_KEYS}
+    result['upper_knees'] = get_boundary_knees(config, 'upper')
+    result['lower_knees'] = get_boundary_knees(config, 'lower')
+    return result
+
+def build_boundary_knots(slope, intercept, knees, side):
+    """将边界线的拐点列表转换为按x排序的分段线性节点
+
+    返回 (knots_x, knots_y, slopes)，slopes 比节点多一个：
+    slopes[i] 是第i个节点左侧区间的斜率，slopes[-1] 是最后一个节点右侧的斜率。
+    """
+    if slope == 0:
+        # 标准线水平时边界线也是水平的：拐点要么处处越过、要么都不越过，
+        # 越过后的斜率仍为0，因此拐点不影响边界线
+        return np.array([0.0]), np.array([intercept]), np.array([0.0, 0.0])
+
+    # 从标准线出发，依次经过各个拐点向外延伸
+    knots_x = []
+    knots_y = []
+    segment_slopes = [slope]
+    x = y = None
+    for threshold, ratio in knees:
+        if ratio < 0:
+            raise ValueError("斜率变化比例不能为负数")
+        current_slope = segment_slopes[-1]
+        if current_slope == 0:
+            # 斜率已变为0，后续拐点不会再到达
+            break
+        if x is None:
+            x = (threshold - intercept) / slope
+        else:
+            x = x + (threshold - y) / current_slope
+        y = threshold
+        knots_x.append(x)
+        knots_y.append(y)
+        segment_slopes.append(slope * ratio)
+
+    if not knots_x:
+        # 没有拐点时边界线就是平移后的标准线
+        return np.array([0.0]), np.array([intercept]), np.array([slope, slope])
+
+    # 上边界在斜率为正时向右延伸，下边界在斜率为正时向左延伸
+    if (side == 'upper') == (slope > 0):
+        return np.array(knots_x), np.array(knots_y), np.array(segment_slopes)
+    return np.array(knots_x[::-1]), np.array(knots_y[::-1]), np.array(segment_slopes[::-1])
+
+def evaluate_piecewise_linear(x, knots):
+    """向量化计算分段线性函数：对整列x二分查找所在区间，再按该区间的直线求值"""
+    knots_x, knots_y, slopes = knots
+    x = np.asarray(x, dtype=float)
+    segment = np.searchsorted(knots_x, x, side='right')
+    anchor = np.maximum(segment - 1, 0)
+    return knots_y[anchor] + slopes[segment] * (x - knots_x[anchor])
+
+def build_boundary_model(config):
+    """根据配置预先计算标准线和上下边界线的分段线性节点，同一配置只需计算一次"""
     # 计算标准线斜率和截距
-    slope = (point2[1] - point1[1]) / (point2[0] - point1[0])
-    intercept = point1[1] - slope * point1[0]
-    
-    # 计算上边界线在该x坐标的y值
-    upper_intercept = intercept + config['float_ratio']
-    upper_y = slope * x + upper_intercept
-    if upper_y > config['upper_y_threshold']:
-        new_slope = slope * config['upper_slope_ratio']
-        x_threshold = (config['upper_y_threshold'] - upper_intercept) / slope
-        new_intercept = config['upper_y_threshold'] - new_slope * x_threshold
-        upper_y = new_slope * x + new_intercept
-    
-    # 计算下边界线在该x坐标的y值
-    lower_intercept = intercept - config['float_ratio']
-    lower_y = slope * x + lower_intercept
-    if lower_y < config['lower_y_threshold']:
-        new_slope = slope * config['lower_slope_ratio']
-        x_threshold = (config['lower_y_threshold'] - lower_intercept) / slope
-        new_intercept = config['lower_y_threshold'] - new_slope * x_threshold
-        lower_y = new_slope * x + new_intercept
-    
-    # 判断点的位置
-    if y > upper_y:
-        return "超额支付"
-    elif y < lower_y:
-        return "价值低估"
+    slope = (config['point2_y'] - config['point1_y']) / (config['point2_x'] - config['point1_x'])
+    intercept = config['point1_y'] - slope * config['point1_x']
+
+    return {
+        'slope': slope,
+        'intercept': intercept,
+        'upper': build_boundary_knots(slope, intercept + config['float_ratio'],
+                                      get_boundary_knees(config, 'upper'), 'upper'),
+        'lower': build_boundary_knots(slope, intercept - config['float_ratio'],
+                                      get_boundary_knees(config, 'lower'), 'lower'),
+    }
+
+def calculate_chart_geometry(model, x_min, x_max):
+    """计算绘图所需的顶点
+
+    边界线只在节点处转折，只需在坐标轴范围内的节点和两端取值；
+    标准线约束在上下边界线之间，额外在它与边界线的交点处取值。
+    """
+    knots_x = np.concatenate([model['upper'][0], model['lower'][0]])
+    x = np.unique(np.concatenate([[x_min, x_max], knots_x[(knots_x > x_min) & (knots_x < x_max)]]))
+    upper_y = evaluate_piecewise_linear(x, model['upper'])
+    lower_y = evaluate_piecewise_linear(x, model['lower'])
+
+    # 相邻顶点之间三条线都是直线，符号变化处即为交点
+    standard_y = model['slope'] * x + model['intercept']
+    standard_x = [x]
+    for boundary_y in (upper_y, lower_y):
+        diff = standard_y - boundary_y
+        crossing = diff[:-1] * diff[1:] < 0
+        t = diff[:-1][crossing] / (diff[:-1][crossing] - diff[1:][crossing])
+        standard_x.append(x[:-1][crossing] + t * np.diff(x)[crossing])
+    standard_x = np.unique(np.concatenate(standard_x))
+
+    # 标准线约束在上下边界线之间
+    standard_y = model['slope'] * standard_x + model['intercept']
+    standard_upper = evaluate_piecewise_linear(standard_x, model['upper'])
+    standard_lower = evaluate_piecewise_linear(standard_x, model['lower'])
+    standard_y = np.where(standard_y > standard_upper, standard_upper,
+                          np.where(standard_y < standard_lower, standard_lower, standard_y))
+
+    return {
+        'x': x,
+        'upper_y': upper_y,
+        'lower_y': lower_y,
+        'standard_x': standard_x,
+        'standard_y': standard_y,
+    }
+
+def classify_city_region(x, y, config):
+    """判断单个城市在图表中的映射结果，判定规则与 calculate_region_metrics 相同"""
+    point = pd.DataFrame({'人效': [x], 'CR值': [y]})
+    return calculate_region_metrics(point, config)['映射结果'].iloc[0]
+
+def calculate_region_metrics(df, config):
+    """向量化计算映射结果，以及各点到上边界线、下边界线、标准线的有向垂直距离
+
+    距离为 CR值 减去对应线在该人效处的y值：正数表示点在线的上方，负数表示在下方。
+    结果写入 映射结果、距上边界、距下边界、距标准线 四列。
+    """
+    x = pd.to_numeric(df['人效'], errors='coerce').to_numpy(dtype=float)
+    y = pd.to_numeric(df['CR值'], errors='coerce').to_numpy(dtype=float)
+
+    model = build_boundary_model(config)
+    standard_y = model['slope'] * x + model['intercept']
+    upper_y = evaluate_piecewise_linear(x, model['upper'])
+    lower_y = evaluate_piecewise_linear(x, model['lower'])
+
+    upper_distance = y - upper_y
+    lower_distance = y - lower_y
+
+    # 高于上边界为超额支付，低于下边界为价值低估，无效数值标记为数据错误
+    invalid = np.isnan(x) | np.isnan(y)
+    # 直接生成分类编码，避免先构造大量字符串
+    region_codes = np.select(
+        [invalid, upper_distance > 0, lower_distance < 0],
+        [REGION_LABELS.index("数据错误"), REGION_LABELS.index("超额支付"), REGION_LABELS.index("价值低估")],
+        default=REGION_LABELS.index("合理区间")
+    )
+    df['映射结果'] = pd.Categorical.from_codes(region_codes, categories=REGION_LABELS)
+    df['距上边界'] = upper_distance
+    df['距下边界'] = lower_distance
+    df['距标准线'] = y - standard_y
+    return df
+
+def select_top_k(values, k, largest=False):
+    """返回values中最小（或最大）的k个元素的位置，按大小排好序
+
+    使用 np.argpartition 做部分选择，只对选出的k个元素排序，避免对整列做全量排序。
+    NaN 永远不会被选中。
+    """
+    values = np.asarray(values, dtype=float)
+    if largest:
+        values = -values
+    values = np.where(np.isnan(values), np.inf, values)
+
+    k = min(int(k), int(np.isfinite(values).sum()))
+    if k <= 0:
+        return np.array([], dtype=int)
+
+    if k < len(values):
+        candidates = np.argpartition(values, k - 1)[:k]
     else:
-        return "合理区间"
+        candidates = np.arange(len(values))
+    return candidates[np.argsort(values[candidates], kind='stable')]
 
-def create_scatter_plot(df, config):
-    """创建散点图"""
-    fig, ax = plt.subplots(figsize=(12, 8))
-    
-    # 数据类型转换，确保数值列为float类型
-    df = df.copy()
+def find_borderline_cities(df, k=5):
+    """查找距离上下边界线最近的k个城市，即CR值稍有变化就会改变映射结果的城市
+
+    需要先调用 calculate_region_metrics 生成距离列。
+    """
+    margin = np.minimum(np.abs(df['距上边界'].to_numpy(dtype=float)),
+                        np.abs(df['距下边界'].to_numpy(dtype=float)))
+    positions = select_top_k(margin, k)
+    result = df.iloc[positions].copy()
+    result['边界距离'] = margin[positions]
+    return result
+
+def find_outlier_cities(df, k=5):
+    """查找偏离合理区间最远的k个城市（只包含超额支付和价值低估的城市）
+
+    需要先调用 calculate_region_metrics 生成距离列。
+    """
+    excess = np.maximum(df['距上边界'].to_numpy(dtype=float),
+                        -df['距下边界'].to_numpy(dtype=float))
+    # 合理区间内的城市不参与排序
+    excess = np.where(excess > 0, excess, np.nan)
+    positions = select_top_k(excess, k, largest=True)
+    result = df.iloc[positions].copy()
+    result['超出距离'] = excess[positions]
+    return result
+
+# 历史记录数据库路径，可通过环境变量 CR_CHART_HISTORY_DB 指定
+HISTORY_DB_PATH = os.environ.get(
+    'CR_CHART_HISTORY_DB',
+    os.path.join(os.path.expanduser('~'), '.cr_chart_tools', 'history.db')
+)
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_hash TEXT NOT NULL UNIQUE,
+    data_hash TEXT NOT NULL,
+    config_json TEXT NOT NULL,
+    row_count INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    last_run_at TEXT NOT NULL,
+    run_count INTEGER NOT NULL DEFAULT 1,
+    overpay_count INTEGER NOT NULL DEFAULT 0,
+    reasonable_count INTEGER NOT NULL DEFAULT 0,
+    undervalue_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS run_results (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+    row_index INTEGER NOT NULL,
+    city TEXT,
+    efficiency REAL,
+    cr REAL,
+    turnover REAL,
+    region TEXT NOT NULL,
+    upper_distance REAL,
+    lower_distance REAL,
+    standard_distance REAL,
+    PRIMARY KEY (run_id, row_index)
+);
+CREATE INDEX IF NOT EXISTS idx_runs_created_at ON runs(created_at);
+CREATE INDEX IF NOT EXISTS idx_results_city ON run_results(city, run_id);
+CREATE INDEX IF NOT EXISTS idx_results_region ON run_results(region, run_id);
+"""
+
+# runs 表中保存的各区域城市数量，列出历史运行时不必统计每个城市的结果
+RUN_REGION_COUNT_COLUMNS = {
+    '超额支付': 'overpay_count',
+    '合理区间': 'reasonable_count',
+    '价值低估': 'undervalue_count',
+}
+
+@st.cache_resource(show_spinner=False)
+def init_history_db(db_path):
+    """创建历史记录数据库的表和索引并开启WAL模式，每个进程对同一路径只执行一次"""
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    with closing(sqlite3.connect(db_path, timeout=30)) as conn:
+        # WAL模式保存在数据库文件中，之后的连接自动生效，多个会话可以同时读取
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(HISTORY_SCHEMA)
+
+        # 旧版数据库补充各区域城市数量列
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(runs)")}
+        with conn:
+            for region, column in RUN_REGION_COUNT_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE runs ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+                    conn.execute(
+                        f"UPDATE runs SET {column} = (SELECT COUNT(*) FROM run_results AS r "
+                        f"WHERE r.run_id = runs.run_id AND r.region = ?)",
+                        (region,)
+                    )
+    return db_path
+
+def connect_history_db(db_path=None, create=True):
+    """打开历史记录数据库连接
+
+    数据库不存在且 create=False 时返回None，只查询历史记录时不会创建数据库。
+    """
+    db_path = db_path or HISTORY_DB_PATH
+    if not os.path.exists(db_path):
+        if not create:
+            return None
+        # 数据库文件在运行期间被删除时，需要重新建表
+        init_history_db.clear()
+    init_history_db(db_path)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+def sql_values(values):
+    """将数值列转换为写入SQLite的列表，NaN写入为NULL"""
+    values = np.asarray(values, dtype=float)
+    result = values.astype(object)
+    result[np.isnan(values)] = None
+    return result.tolist()
+
+def compute_run_hash(df, config):
+    """计算数据和映射配置的哈希，相同数据和配置的运行哈希相同
+
+    颜色、坐标轴等不影响映射结果的配置不参与哈希。
+    数值统一按float32精度参与哈希，切换数值存储精度不会产生重复的运行记录；
+    只在float32精度以内不同的数据视为同一份数据。
+    """
+    data = pd.DataFrame({
+        '城市': df['城市'].astype(str),
+        '人效': pd.to_numeric(df['人效'], errors='coerce').astype(np.float32),
+        'CR值': pd.to_numeric(df['CR值'], errors='coerce').astype(np.float32),
+        '离职率': pd.to_numeric(df['离职率'], errors='coerce').astype(np.float32),
+    })
+    row_hashes = pd.util.hash_pandas_object(data, index=False).to_numpy()
+    data_hash = hashlib.sha256(row_hashes.tobytes()).hexdigest()
+
+    config_json = json.dumps(classification_config(config), sort_keys=True)
+    run_hash = hashlib.sha256(f"{data_hash}:{config_json}".encode('utf-8')).hexdigest()
+    return run_hash, data_hash, config_json
+
+def save_classification_run(df, run_hash, data_hash, config_json, db_path=None):
+    """保存一次映射结果计算，返回运行编号
+
+    df 需要已由 calculate_region_metrics 生成映射结果和距离列。
+    相同数据和配置已保存过时只更新最近运行时间和运行次数，不再写入每个城市的结果。
+    """
+    now = datetime.now().isoformat(timespec='seconds')
+    region_counts = df['映射结果'].value_counts()
+    with closing(connect_history_db(db_path)) as conn, conn:
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO runs (run_hash, data_hash, config_json, row_count, created_at, last_run_at, "
+            "overpay_count, reasonable_count, undervalue_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (run_hash, data_hash, config_json, len(df), now, now,
+             *(int(region_counts.get(region, 0)) for region in RUN_REGION_COUNT_COLUMNS))
+        )
+        if cursor.rowcount == 0:
+            conn.execute(
+                "UPDATE runs SET last_run_at = ?, run_count = run_count + 1 WHERE run_hash = ?",
+                (now, run_hash)
+            )
+            return conn.execute("SELECT run_id FROM runs WHERE run_hash = ?", (run_hash,)).fetchone()[0]
+
+        run_id = cursor.lastrowid
+        records = zip(
+            [run_id] * len(df),
+            range(len(df)),
+            df['城市'].astype(str).tolist(),
+            sql_values(pd.to_numeric(df['人效'], errors='coerce')),
+            sql_values(pd.to_numeric(df['CR值'], errors='coerce')),
+            sql_values(pd.to_numeric(df['离职率'], errors='coerce')),
+            df['映射结果'].astype(str).tolist(),
+            sql_values(df['距上边界']),
+            sql_values(df['距下边界']),
+            sql_values(df['距标准线']),
+        )
+        conn.executemany("INSERT INTO run_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", records)
+    return run_id
+
+def list_classification_runs(limit=20, db_path=None):
+    """列出最近的映射结果计算记录，包含各区域的城市数量"""
+    conn = connect_history_db(db_path, create=False)
+    if conn is None:
+        return pd.DataFrame()
+    with closing(conn):
+        return pd.read_sql_query(
+            "SELECT run_id AS 运行编号, created_at AS 首次运行时间, last_run_at AS 最近运行时间, "
+            "run_count AS 运行次数, row_count AS 城市数量, overpay_count AS 超额支付, "
+            "reasonable_count AS 合理区间, undervalue_count AS 价值低估 "
+            "FROM runs ORDER BY created_at DESC, run_id DESC LIMIT ?",
+            conn, params=(int(limit),)
+        )
+
+def query_city_history(city, db_path=None):
+    """查询某个城市在各次运行中的映射结果，按时间先后排列"""
+    conn = connect_history_db(db_path, create=False)
+    if conn is None:
+        return pd.DataFrame()
+    with closing(conn):
+        return pd.read_sql_query(
+            "SELECT runs.run_id AS 运行编号, runs.created_at AS 运行时间, r.efficiency AS 人效, "
+            "r.cr AS CR值, r.region AS 映射结果, r.upper_distance AS 距上边界, r.lower_distance AS 距下边界 "
+            "FROM run_results AS r JOIN runs ON runs.run_id = r.run_id "
+            "WHERE r.city = ? ORDER BY runs.created_at, runs.run_id",
+            conn, params=(str(city),)
+        )
+
+def query_region_transitions(region, last_n_runs=6, db_path=None):
+    """查询最近n次运行中从其他区域变为指定区域的城市
+
+    每次运行与它的上一次运行比较，只统计两次运行中都出现的城市。
+    依次遍历这n次运行，通过区域索引 (region, run_id) 取出属于该区域的城市，
+    再通过城市索引 (city, run_id) 直接查到该城市在上一次运行中的映射结果。
+    """
+    conn = connect_history_db(db_path, create=False)
+    if conn is None:
+        return pd.DataFrame()
+    with closing(conn):
+        # CROSS JOIN 固定连接顺序，保证两次查找都按索引的全部列进行
+        return pd.read_sql_query(
+            "WITH recent AS ("
+            "    SELECT run_id, created_at, LAG(run_id) OVER (ORDER BY created_at, run_id) AS prev_run_id "
+            "    FROM (SELECT run_id, created_at FROM runs ORDER BY created_at DESC, run_id DESC LIMIT ?)"
+            ") "
+            "SELECT r.city AS 城市, p.region AS 原映射结果, r.region AS 映射结果, "
+            "       recent.run_id AS 运行编号, recent.created_at AS 变化时间 "
+            "FROM recent CROSS JOIN run_results AS r CROSS JOIN run_results AS p "
+            "WHERE r.region = ? AND r.run_id = recent.run_id "
+            "  AND p.city = r.city AND p.run_id = recent.prev_run_id AND p.region != r.region "
+            "ORDER BY recent.created_at DESC, recent.run_id DESC, r.city",
+            conn, params=(int(last_n_runs), region)
+        )
+
+def prepare_plot_data(df):
+    """清洗绘图数据：数值列转换为float并删除无效行"""
     try:
         # 先检查数据是否为空
         if df.empty:
             raise ValueError("输入数据为空")
         
+        # 只取绘图需要的列，避免复制整张会话数据
         # 转换数值列，使用errors='coerce'将无效值转为NaN
-        df['人效'] = pd.to_numeric(df['人效'], errors='coerce')
-        df['CR值'] = pd.to_numeric(df['CR值'], errors='coerce')
-        df['离职率'] = pd.to_numeric(df['离职率'], errors='coerce')
+        df = pd.DataFrame({
+            '城市': df['城市'],
+            '人效': pd.to_numeric(df['人效'], errors='coerce'),
+            'CR值': pd.to_numeric(df['CR值'], errors='coerce'),
+            '离职率': pd.to_numeric(df['离职率'], errors='coerce'),
+        }, copy=False)
         
         # 检查转换后是否有有效数据
         valid_rows_before = len(df)
@@ -208,170 +613,246 @@ def create_scatter_plot(df, config):
     except Exception as e:
         raise ValueError(f"数据格式错误：{str(e)}。请确保人效、CR值、离职率列包含有效数值")
     
-    # 获取配置参数
-    x_min = config['x_min']
-    x_max = config['x_max']
-    y_min = config['y_min']
-    y_max = config['y_max']
-    
-    # 基准点和标准线
-    point1 = (config['point1_x'], config['point1_y'])
-    point2 = (config['point2_x'], config['point2_y'])
-    
-    # 计算标准线斜率和截距
-    slope = (point2[1] - point1[1]) / (point2[0] - point1[0])
-    intercept = point1[1] - slope * point1[0]
-    
-    # 生成x轴范围
-    x_range = np.linspace(x_min, x_max, 1000)
-    
-    # 计算上边界线
-    upper_intercept = intercept + config['float_ratio']
-    raw_upper_x, raw_upper_y = calculate_boundary_lines(
-        x_range, slope, upper_intercept, 
-        config['upper_y_threshold'], config['upper_slope_ratio']
-    )
-    
-    # 计算下边界线
-    lower_intercept = intercept - config['float_ratio']
-    raw_lower_x, raw_lower_y = calculate_lower_boundary_lines(
-        x_range, slope, lower_intercept,
-        config['lower_y_threshold'], config['lower_slope_ratio']
-    )
-    
-    # 直接使用原始边界线数据，不做交叉处理
-    upper_x = raw_upper_x
-    upper_y = raw_upper_y
-    lower_x = raw_lower_x
-    lower_y = raw_lower_y
-    
-    # 填充区域
-    # 超额支付区域（上边界线以上）
-    if len(upper_x) > 0 and len(upper_y) > 0:
-        ax.fill_between(x_range, upper_y, y_max, 
-                       color=config['overpay_color'], alpha=0.3, label='超额支付')
-    
-    # 价值低估区域（下边界线以下）
-    if len(lower_x) > 0 and len(lower_y) > 0:
-        # 为下边界线创建对应的y值数组
-        lower_y_full = np.interp(x_range, lower_x, lower_y, left=y_min, right=y_min)
-        ax.fill_between(x_range, y_min, lower_y_full, 
-                       color=config['undervalue_color'], alpha=0.3, label='价值低估')
-    
-    # 合理区间（两条边界线之间）
-    if len(upper_x) > 0 and len(upper_y) > 0 and len(lower_x) > 0 and len(lower_y) > 0:
-        # 为下边界线创建对应的y值数组
-        lower_y_full = np.interp(x_range, lower_x, lower_y, left=y_min, right=y_min)
-        ax.fill_between(x_range, lower_y_full, upper_y, 
-                       color=config['reasonable_color'], alpha=0.3, label='合理区间')
-    elif len(upper_x) > 0 and len(upper_y) > 0:
-        # 如果只有上边界线，填充从y_min到上边界线
-        ax.fill_between(x_range, y_min, upper_y, 
-                       color=config['reasonable_color'], alpha=0.3, label='合理区间')
-    elif len(lower_x) > 0 and len(lower_y) > 0:
-        # 如果只有下边界线，填充从下边界线到y_max
-        lower_y_full = np.interp(x_range, lower_x, lower_y, left=y_min, right=y_min)
-        ax.fill_between(x_range, lower_y_full, y_max, 
-                       color=config['reasonable_color'], alpha=0.3, label='合理区间')
-    
-    # 绘制标准线（添加边界约束）
-    standard_y = slope * x_range + intercept
-    
-    # 确保标准线不超出上下边界线的范围
-    # 对每个x点，标准线的y值应该在对应的上下边界线之间
-    for i in range(len(standard_y)):
-        # 找到对应x值在边界线中的位置
-        x_val = x_range[i]
+    return df
+
+def band_polygon(x, y_bottom, y_top):
+    """生成填充区域的多边形顶点：沿上沿正向、沿下沿反向"""
+    x = np.asarray(x, dtype=float)
+    y_bottom = np.broadcast_to(np.asarray(y_bottom, dtype=float), x.shape)
+    y_top = np.broadcast_to(np.asarray(y_top, dtype=float), x.shape)
+    return np.column_stack([
+        np.concatenate([x, x[::-1]]),
+        np.concatenate([y_top, y_bottom[::-1]])
+    ])
+
+# 页面上显示图表使用的分辨率（与 st.pyplot 的默认值相同），下载的图片使用300dpi
+CHART_DISPLAY_DPI = 200
+CHART_DOWNLOAD_DPI = 300
+
+# Streamlit 1.52.0 起 st.download_button 可以传入函数，点击下载时才生成文件
+DEFERRED_DOWNLOAD = Version(st.__version__) >= Version('1.52.0')
+
+class ScatterPlotRenderer:
+    """可复用的散点图渲染器
+
+    图形、坐标轴、刻度、网格等静态图层只在坐标轴范围变化时重建；
+    数据变化时只更新散点位置、颜色和城市标签，配置变化时只更新区域多边形和线条顶点。
+    每个会话保存一个实例，重复生成图表时复用同一个 Figure。
+    """
+
+    # 这些参数决定坐标轴范围和刻度，变化时需要完整重建图形
+    LAYOUT_KEYS = ('x_min', 'x_max', 'y_min', 'y_max', 'x_step', 'y_step')
+    COLOR_KEYS = ('reasonable_color', 'overpay_color', 'undervalue_color')
+
+    def __init__(self):
+        self.fig = None
+        self.ax = None
+        self.layout_state = None
+        self.boundary_state = None
+        self.color_state = None
+        self.data_state = None
+        self.city_labels = []
+        self.png_cache = {}
+
+    def render(self, df, config):
+        """根据数据和配置渲染图表，只更新发生变化的部分，返回 Figure
+
+        数据和边界线配置先校验，出错时不改动当前图形；坐标轴范围变化时在新的渲染器中完整绘制，
+        成功后才替换当前图形和PNG缓存，失败时保留上一次生成的图表。
+        """
+        df = prepare_plot_data(df)
+        model = build_boundary_model(config)
+
+        layout_state = tuple(config.get(key) for key in self.LAYOUT_KEYS)
+        if self.fig is None or layout_state != self.layout_state:
+            candidate = type(self)()
+            try:
+                candidate.build(config)
+                candidate.layout_state = layout_state
+                candidate.update(df, config, model)
+            except Exception:
+                if candidate.fig is not None:
+                    plt.close(candidate.fig)
+                raise
+            if self.fig is not None:
+                plt.close(self.fig)
+            self.__dict__.update(candidate.__dict__)
+            return self.fig
+
+        try:
+            self.update(df, config, model)
+        except Exception:
+            # 图形可能只更新了一部分，下次渲染时完整重建
+            self.layout_state = None
+            raise
+        return self.fig
+
+    def update(self, df, config, model):
+        """按变化的部分更新图层，全部成功后才清空PNG缓存"""
+        changed = False
+
+        # 区域和线条的位置由映射配置决定
+        boundary_state = json.dumps(classification_config(config), sort_keys=True)
+        if boundary_state != self.boundary_state:
+            self.update_boundaries(config, model)
+            self.boundary_state = boundary_state
+            changed = True
+
+        color_state = tuple(config[key] for key in self.COLOR_KEYS)
+        if color_state != self.color_state:
+            self.update_colors(config)
+            self.color_state = color_state
+            changed = True
+
+        data_state = (
+            tuple(df['城市'].astype(str)),
+            df['人效'].to_numpy().tobytes(),
+            df['CR值'].to_numpy().tobytes(),
+            df['离职率'].to_numpy().tobytes(),
+        )
+        if data_state != self.data_state:
+            self.update_scatter(df)
+            self.data_state = data_state
+            changed = True
+
+        if changed:
+            self.png_cache = {}
+
+    def build(self, config):
+        """在新的 Figure 中创建所有静态图层，只在尚未绘制过的渲染器上调用"""
+        fig, ax = plt.subplots(figsize=(12, 8))
+        self.fig = fig
+        self.ax = ax
+
+        x_min = config['x_min']
+        x_max = config['x_max']
+        y_min = config['y_min']
+        y_max = config['y_max']
+
+        empty_polygon = np.zeros((0, 2))
+
+        # 填充区域，顶点在 update_boundaries 中设置
+        self.overpay_band = Polygon(empty_polygon, closed=True, alpha=0.3, linewidth=0, label='超额支付')
+        self.undervalue_band = Polygon(empty_polygon, closed=True, alpha=0.3, linewidth=0, label='价值低估')
+        self.reasonable_band = Polygon(empty_polygon, closed=True, alpha=0.3, linewidth=0, label='合理区间')
+        for band in (self.overpay_band, self.undervalue_band, self.reasonable_band):
+            ax.add_patch(band)
+
+        # 标准线和边界线（实线，变细），顶点在 update_boundaries 中设置
+        self.standard_line, = ax.plot([], [], 'g-', linewidth=1, label='标准线')
+        self.upper_line, = ax.plot([], [], 'r-', linewidth=1, label='上边界线')
+        self.lower_line, = ax.plot([], [], 'b-', linewidth=1, label='下边界线')
+
+        # 基于基准点1的参考线（虚线）
+        self.reference_hline = ax.axhline(y=config['point1_y'], color='gray', linestyle='--', linewidth=0.8, alpha=0.7)
+        self.reference_vline = ax.axvline(x=config['point1_x'], color='gray', linestyle='--', linewidth=0.8, alpha=0.7)
+
+        # 散点及颜色条，颜色映射始终从0开始
+        self.scatter = ax.scatter([], [], c=[], cmap='Reds', vmin=0, vmax=0.1,
+                                  s=100, alpha=0.7, edgecolors='black', linewidth=0.5)
+        self.colorbar = fig.colorbar(self.scatter, ax=ax)
+        self.colorbar.set_label('离职率', rotation=270, labelpad=15)
+
+        # 设置坐标轴
+        ax.set_xlim(x_min, x_max)
+        ax.set_ylim(y_min, y_max)
         
-        # 计算该x值对应的上下边界线y值
-        if len(upper_x) > 0 and len(upper_y) > 0:
-            upper_y_val = np.interp(x_val, upper_x, upper_y)
-        else:
-            upper_y_val = y_max
-            
-        if len(lower_x) > 0 and len(lower_y) > 0:
-            lower_y_val = np.interp(x_val, lower_x, lower_y)
-        else:
-            lower_y_val = y_min
+        # 设置X轴刻度，使用计算出的步长，确保不超出范围
+        x_step = config.get('x_step', 1.0)
+        # 生成刻度，确保不超出x_max
+        x_ticks = np.arange(x_min, x_max + x_step/2, x_step)
+        # 过滤掉超出范围的刻度
+        x_ticks = x_ticks[x_ticks <= x_max]
+        ax.set_xticks(x_ticks)
         
-        # 约束标准线在边界线范围内
-        if standard_y[i] > upper_y_val:
-            standard_y[i] = upper_y_val
-        elif standard_y[i] < lower_y_val:
-            standard_y[i] = lower_y_val
-    
-    ax.plot(x_range, standard_y, 'g-', linewidth=1, label='标准线')
-    
-    # 绘制边界线（实线，变细）
-    if len(upper_x) > 0 and len(upper_y) > 0:
-        ax.plot(upper_x, upper_y, 'r-', linewidth=1, label='上边界线')
-    if len(lower_x) > 0 and len(lower_y) > 0:
-        ax.plot(lower_x, lower_y, 'b-', linewidth=1, label='下边界线')
-    
-    # 绘制基于基准点1的参考线（虚线）
-    ax.axhline(y=point1[1], color='gray', linestyle='--', linewidth=0.8, alpha=0.7)
-    ax.axvline(x=point1[0], color='gray', linestyle='--', linewidth=0.8, alpha=0.7)
-    
-    # 绘制散点
-    if not df.empty:
+        # 设置Y轴刻度，使用计算出的步长，确保不超出范围
+        y_step = config.get('y_step', 0.1)
+        # 生成刻度，确保不超出y_max
+        y_ticks = np.arange(y_min, y_max + y_step/2, y_step)
+        # 过滤掉超出范围的刻度
+        y_ticks = y_ticks[y_ticks <= y_max]
+        ax.set_yticks(y_ticks)
+        ax.set_xlabel('人效', fontsize=12)
+        ax.set_ylabel('CR值', fontsize=12)
+        ax.set_title('城市人效与CR值分析图', fontsize=14, fontweight='bold')
+        
+        # 添加网格
+        ax.grid(True, alpha=0.3)
+        
+        fig.tight_layout()
+
+    def update_boundaries(self, config, model):
+        """更新区域多边形、标准线、边界线和参考线的顶点"""
+        x_min, x_max = self.ax.get_xlim()
+        y_min, y_max = self.ax.get_ylim()
+
+        # 顶点数量只取决于拐点数量，与坐标轴范围和数据量无关
+        geometry = calculate_chart_geometry(model, x_min, x_max)
+        x = geometry['x']
+        upper_y = geometry['upper_y']
+        lower_y = geometry['lower_y']
+
+        self.overpay_band.set_xy(band_polygon(x, upper_y, y_max))
+        self.undervalue_band.set_xy(band_polygon(x, y_min, lower_y))
+        self.reasonable_band.set_xy(band_polygon(x, lower_y, upper_y))
+
+        self.standard_line.set_data(geometry['standard_x'], geometry['standard_y'])
+        self.upper_line.set_data(x, upper_y)
+        self.lower_line.set_data(x, lower_y)
+
+        self.reference_hline.set_ydata([config['point1_y'], config['point1_y']])
+        self.reference_vline.set_xdata([config['point1_x'], config['point1_x']])
+
+    def update_colors(self, config):
+        """更新区域颜色，图例按新颜色重新生成"""
+        self.overpay_band.set_facecolor(config['overpay_color'])
+        self.undervalue_band.set_facecolor(config['undervalue_color'])
+        self.reasonable_band.set_facecolor(config['reasonable_color'])
+
+        # 添加图例
+        handles = [self.overpay_band, self.undervalue_band, self.reasonable_band,
+                   self.standard_line, self.upper_line, self.lower_line]
+        self.ax.legend(handles=handles, loc='upper left', bbox_to_anchor=(0, 1))
+
+    def update_scatter(self, df):
+        """更新散点位置、离职率颜色、颜色条刻度和城市标签"""
         # 根据离职率设置颜色深度，确保颜色映射始终从0开始
         turnover_min = 0  # 强制设置最小值为0
         turnover_max = max(df['离职率'].max(), 0.1)  # 确保最大值至少为0.1，避免除零错误
-        
-        # 标准化离职率到0-1范围，确保从0开始
-        normalized_turnover = (df['离职率'] - turnover_min) / (turnover_max - turnover_min)
-        # 确保标准化后的值在0-1范围内
-        normalized_turnover = np.clip(normalized_turnover, 0, 1)
-        
-        scatter = ax.scatter(df['人效'], df['CR值'], 
-                           c=df['离职率'], cmap='Reds', 
-                           vmin=turnover_min, vmax=turnover_max,  # 设置颜色条范围从0开始
-                           s=100, alpha=0.7, edgecolors='black', linewidth=0.5)
-        
-        # 添加城市标签
-        for i, row in df.iterrows():
-            ax.annotate(row['城市'], 
-                       (row['人效'], row['CR值']), 
-                       xytext=(5, 5), textcoords='offset points',
-                       fontsize=8, ha='left')
-        
-        # 添加颜色条，确保从0开始显示
-        cbar = plt.colorbar(scatter, ax=ax)
-        cbar.set_label('离职率', rotation=270, labelpad=15)
+
+        self.scatter.set_offsets(np.column_stack([df['人效'].to_numpy(), df['CR值'].to_numpy()]))
+        self.scatter.set_array(df['离职率'].to_numpy())
+        self.scatter.set_clim(turnover_min, turnover_max)
         # 设置颜色条的刻度，确保从0开始
-        cbar.set_ticks(np.linspace(turnover_min, turnover_max, 6))
-    
-    # 设置坐标轴
-    ax.set_xlim(x_min, x_max)
-    ax.set_ylim(y_min, y_max)
-    
-    # 设置X轴刻度，使用计算出的步长，确保不超出范围
-    x_step = config.get('x_step', 1.0)
-    # 生成刻度，确保不超出x_max
-    x_ticks = np.arange(x_min, x_max + x_step/2, x_step)
-    # 过滤掉超出范围的刻度
-    x_ticks = x_ticks[x_ticks <= x_max]
-    ax.set_xticks(x_ticks)
-    
-    # 设置Y轴刻度，使用计算出的步长，确保不超出范围
-    y_step = config.get('y_step', 0.1)
-    # 生成刻度，确保不超出y_max
-    y_ticks = np.arange(y_min, y_max + y_step/2, y_step)
-    # 过滤掉超出范围的刻度
-    y_ticks = y_ticks[y_ticks <= y_max]
-    ax.set_yticks(y_ticks)
-    ax.set_xlabel('人效', fontsize=12)
-    ax.set_ylabel('CR值', fontsize=12)
-    ax.set_title('城市人效与CR值分析图', fontsize=14, fontweight='bold')
-    
-    # 添加网格
-    ax.grid(True, alpha=0.3)
-    
-    # 添加图例
-    ax.legend(loc='upper left', bbox_to_anchor=(0, 1))
-    
-    plt.tight_layout()
-    return fig
+        self.colorbar.set_ticks(np.linspace(turnover_min, turnover_max, 6))
+
+        # 城市标签数量随数据变化，直接替换
+        for label in self.city_labels:
+            label.remove()
+        self.city_labels = [
+            self.ax.annotate(city, (x, y),
+                             xytext=(5, 5), textcoords='offset points',
+                             fontsize=8, ha='left')
+            for city, x, y in zip(df['城市'], df['人效'], df['CR值'])
+        ]
+
+    def to_png(self, dpi=300, tight=True):
+        """导出PNG图片，图表未变化时直接返回缓存的结果
+
+        tight=True 时按内容裁剪边距，需要额外绘制一遍图形；
+        build 中已经调用过 tight_layout，页面显示时可以不裁剪。
+        """
+        key = (dpi, tight)
+        if key not in self.png_cache:
+            img_buffer = io.BytesIO()
+            self.fig.savefig(img_buffer, format='png', dpi=dpi, bbox_inches='tight' if tight else None)
+            self.png_cache[key] = img_buffer.getvalue()
+        return self.png_cache[key]
+
+def create_scatter_plot(df, config):
+    """创建散点图"""
+    return ScatterPlotRenderer().render(df, config)
+
 
 def main():
     st.title("📊 城市人效与CR值分析工具")
@@ -406,10 +887,28 @@ def main():
     # 边界线配置
     st.sidebar.subheader("边界线配置")
     float_ratio = st.sidebar.number_input("浮动比例", value=0.15, step=0.01)
-    upper_y_threshold = st.sidebar.number_input("上边界Y轴阈值", value=1.25, step=0.1)
-    upper_slope_ratio = st.sidebar.number_input("上边界斜率变化比例", value=0.5, step=0.1)
-    lower_y_threshold = st.sidebar.number_input("下边界Y轴阈值", value=0.75, step=0.1)
-    lower_slope_ratio = st.sidebar.number_input("下边界斜率变化比例", value=0.5, step=0.1)
+    
+    # 拐点：边界线越过Y轴阈值后，斜率变为标准线斜率乘以变化比例，可添加多行
+    knee_column_config = {
+        "Y轴阈值": st.column_config.NumberColumn("Y轴阈值", step=0.01, format="%.2f"),
+        "斜率变化比例": st.column_config.NumberColumn("斜率变化比例", min_value=0.0, step=0.1, format="%.2f")
+    }
+    st.sidebar.caption("上边界拐点（y值超过阈值后改变斜率）")
+    upper_knees = parse_boundary_knees(st.sidebar.data_editor(
+        pd.DataFrame({'Y轴阈值': [1.25], '斜率变化比例': [0.5]}),
+        num_rows="dynamic",
+        hide_index=True,
+        key="upper_knees",
+        column_config=knee_column_config
+    ))
+    st.sidebar.caption("下边界拐点（y值低于阈值后改变斜率）")
+    lower_knees = parse_boundary_knees(st.sidebar.data_editor(
+        pd.DataFrame({'Y轴阈值': [0.75], '斜率变化比例': [0.5]}),
+        num_rows="dynamic",
+        hide_index=True,
+        key="lower_knees",
+        column_config=knee_column_config
+    ))
     
     # 颜色配置
     st.sidebar.subheader("颜色配置")
@@ -417,6 +916,14 @@ def main():
     overpay_color = st.sidebar.color_picker("超额支付颜色", value="#FFB6C1")
     undervalue_color = st.sidebar.color_picker("价值低估颜色", value="#87CEEB")
     
+    # 性能配置
+    st.sidebar.subheader("性能配置")
+    use_float32 = st.sidebar.checkbox("数值使用float32存储", value=False, help="数据量较大时可减少一半数值列内存，精度约7位有效数字")
+    # 切换精度时直接转换当前会话数据，保留已编辑的数据和映射结果
+    if 'df' in st.session_state and st.session_state.get('numeric_float32', False) != use_float32:
+        set_numeric_precision(st.session_state['df'], use_float32)
+    st.session_state['numeric_float32'] = use_float32
+    
     # 主界面布局
     col1, col2 = st.columns([1, 1])
     
@@ -442,10 +949,7 @@ def main():
                    '离职率': [0.02, 0.025, 0.03, 0.035, 0.04, 0.045, 0.05, 0.055, 0.06, 0.065, 0.07, 0.075, 0.08, 0.085, 0.09, 0.095, 0.10, 0.105, 0.11]
                  }
                 df = pd.DataFrame(sample_data)
-                # 确保映射结果列存在
-                if '映射结果' not in df.columns:
-                    df['映射结果'] = ""
-                st.session_state['df'] = df
+                st.session_state['df'] = compact_city_data(df, use_float32)
                 st.success("示例数据已加载！")
         
         with col_b:
@@ -468,22 +972,23 @@ def main():
                 help="下载标准数据格式模板"
             )
         
-        # 处理上传的文件
-        if uploaded_file is not None:
-            try:
-                if uploaded_file.name.endswith('.csv'):
-                    df = pd.read_csv(uploaded_file)
-                else:
-                    df = pd.read_excel(uploaded_file)
-                
-                # 确保映射结果列存在
-                if '映射结果' not in df.columns:
-                    df['映射结果'] = ""
-                
-                st.session_state['df'] = df
-                st.success("文件上传成功！")
-            except Exception as e:
-                st.error(f"文件读取错误：{str(e)}")
+        # 处理上传的文件（每次上传只读取一次，避免每次刷新都覆盖会话数据）
+        if uploaded_file is None:
+            st.session_state.pop('upload_key', None)
+        else:
+            upload_key = uploaded_file.file_id
+            if st.session_state.get('upload_key') != upload_key:
+                try:
+                    if uploaded_file.name.endswith('.csv'):
+                        df = pd.read_csv(uploaded_file)
+                    else:
+                        df = pd.read_excel(uploaded_file)
+                    
+                    st.session_state['df'] = compact_city_data(df, use_float32)
+                    st.session_state['upload_key'] = upload_key
+                    st.success("文件上传成功！")
+                except Exception as e:
+                    st.error(f"文件读取错误：{str(e)}")
         
         # 显示和编辑数据
         if 'df' in st.session_state:
@@ -500,9 +1005,7 @@ def main():
                 st.success("数据格式正确！")
             
             # 移除映射结果列（如果存在）
-            df_for_editor = st.session_state['df'].copy()
-            if '映射结果' in df_for_editor.columns:
-                df_for_editor = df_for_editor.drop(columns=['映射结果'])
+            df_for_editor = editor_view(st.session_state['df'])
             
             edited_df = st.data_editor(
                 df_for_editor,
@@ -533,14 +1036,14 @@ def main():
             
             # 检查数据是否有变化
             if not df_for_editor.equals(edited_df):
-                # 更新session state中的数据（不包含映射结果列）
-                st.session_state['df'] = edited_df.copy()
+                # 更新session state中的数据（不包含映射结果列，需重新计算）
+                st.session_state['df'] = compact_city_data(edited_df, use_float32)
             
             # 显示映射结果表格（如果存在）
-            if 'mapping_results' in st.session_state and st.session_state['mapping_results'] is not None:
+            if '映射结果' in st.session_state['df'].columns:
                 st.subheader("📊 映射结果")
                 st.dataframe(
-                    st.session_state['mapping_results'],
+                    st.session_state['df'],
                     use_container_width=True,
                     column_config={
                         "人效": st.column_config.NumberColumn(
@@ -561,9 +1064,48 @@ def main():
                         "映射结果": st.column_config.TextColumn(
                             "映射结果",
                             help="城市在图表中的映射结果"
+                        ),
+                        "距上边界": st.column_config.NumberColumn(
+                            "距上边界",
+                            help="CR值与上边界线的差值，正数表示超出上边界",
+                            format="%.3f"
+                        ),
+                        "距下边界": st.column_config.NumberColumn(
+                            "距下边界",
+                            help="CR值与下边界线的差值，负数表示低于下边界",
+                            format="%.3f"
+                        ),
+                        "距标准线": st.column_config.NumberColumn(
+                            "距标准线",
+                            help="CR值与标准线的差值",
+                            format="%.3f"
                         )
                     }
                 )
+
+                # 临界城市与离群城市
+                mapping_results = st.session_state['df']
+                top_k = st.number_input("临界/离群城市显示数量", min_value=1, value=5, step=1)
+                display_columns = ['城市', '人效', 'CR值', '映射结果']
+
+                st.subheader("⚖️ 临界城市（距边界线最近）")
+                borderline = find_borderline_cities(mapping_results, top_k)
+                st.dataframe(
+                    borderline[display_columns + ['边界距离']],
+                    use_container_width=True,
+                    hide_index=True
+                )
+
+                st.subheader("🚩 离群城市（偏离合理区间最远）")
+                outliers = find_outlier_cities(mapping_results, top_k)
+                if outliers.empty:
+                    st.info("所有城市均在合理区间内")
+                else:
+                    st.dataframe(
+                        outliers[display_columns + ['超出距离']],
+                        use_container_width=True,
+                        hide_index=True
+                    )
     
     with col2:
         st.header("数据分析")
@@ -573,8 +1115,8 @@ def main():
             if 'df' not in st.session_state:
                 st.error("请先导入数据！")
             else:
-                # 使用数据编辑器中当前显示的数据进行验证和计算
-                current_data = edited_df if 'edited_df' in locals() else st.session_state['df']
+                # 会话数据已与数据编辑器同步，直接在其上验证和计算
+                current_data = st.session_state['df']
                 
                 # 验证数据
                 errors, warnings = validate_data(current_data)
@@ -590,13 +1132,6 @@ def main():
                             st.warning(f"⚠️ {warning}")
                     
                     try:
-                        # 使用数据编辑器中的当前数据进行处理
-                        df_with_region = current_data.copy()
-                        
-                        # 强制转换数值列类型
-                        df_with_region['人效'] = pd.to_numeric(df_with_region['人效'], errors='coerce')
-                        df_with_region['CR值'] = pd.to_numeric(df_with_region['CR值'], errors='coerce')
-                        
                         # 配置参数
                         config = {
                             'x_min': x_min, 'x_max': x_max, 'y_min': y_min, 'y_max': y_max,
@@ -604,19 +1139,21 @@ def main():
                             'point1_x': point1_x, 'point1_y': point1_y,
                             'point2_x': point2_x, 'point2_y': point2_y,
                             'float_ratio': float_ratio,
-                            'upper_y_threshold': upper_y_threshold, 'upper_slope_ratio': upper_slope_ratio,
-                            'lower_y_threshold': lower_y_threshold, 'lower_slope_ratio': lower_slope_ratio,
+                            'upper_knees': upper_knees, 'lower_knees': lower_knees,
                             'reasonable_color': reasonable_color, 'overpay_color': overpay_color, 'undervalue_color': undervalue_color
                         }
                         
                         with st.spinner("正在计算映射结果..."):
-                            # 计算映射结果
-                            df_with_region['映射结果'] = df_with_region.apply(
-                                lambda row: classify_city_region(row['人效'], row['CR值'], config), axis=1
-                            )
+                            # 计算映射结果及到边界线的距离，直接追加到会话数据中，用于在预览数据下方显示
+                            calculate_region_metrics(current_data, config)
+                            set_numeric_precision(current_data, use_float32)
                             
-                            # 保存映射结果到session state，用于在预览数据下方显示
-                            st.session_state['mapping_results'] = df_with_region
+                            # 相同数据和配置已保存过时只更新运行次数，重新计算比读取已保存的结果更快
+                            try:
+                                run_hash, data_hash, config_json = compute_run_hash(current_data, config)
+                                save_classification_run(current_data, run_hash, data_hash, config_json)
+                            except (sqlite3.Error, OSError) as e:
+                                st.warning(f"保存历史记录失败：{str(e)}")
                             
                             st.success("✅ 映射结果计算完成！请查看下方的映射结果表格。")
                             
@@ -626,6 +1163,51 @@ def main():
                     except Exception as e:
                         st.error(f"计算映射结果时出错：{str(e)}")
         
+        # 历史记录
+        with st.expander("📜 历史记录"):
+            # 折叠时展开区域的内容也会在每次刷新时执行，因此只在勾选后查询数据库
+            show_history = st.checkbox("加载历史记录", value=False)
+            history_runs = None
+            if show_history:
+                try:
+                    history_runs = list_classification_runs()
+                except (sqlite3.Error, OSError) as e:
+                    st.error(f"读取历史记录失败：{str(e)}")
+            
+            if history_runs is not None and history_runs.empty:
+                st.info("暂无历史记录，计算映射结果后会自动保存")
+            elif history_runs is not None:
+                st.dataframe(history_runs, use_container_width=True, hide_index=True)
+                
+                # 城市历史
+                history_city = st.text_input("查询城市的历史映射结果", placeholder="输入城市名称")
+                if history_city:
+                    try:
+                        city_history = query_city_history(history_city.strip())
+                    except (sqlite3.Error, OSError) as e:
+                        city_history = None
+                        st.error(f"读取历史记录失败：{str(e)}")
+                    if city_history is not None and city_history.empty:
+                        st.info(f"没有找到城市“{history_city}”的历史记录")
+                    elif city_history is not None:
+                        st.dataframe(city_history, use_container_width=True, hide_index=True)
+                
+                # 映射结果变化
+                region_col, runs_col = st.columns(2)
+                with region_col:
+                    target_region = st.selectbox("变为以下映射结果的城市", ["超额支付", "合理区间", "价值低估"])
+                with runs_col:
+                    last_n_runs = st.number_input("最近运行次数", min_value=2, value=6, step=1)
+                try:
+                    transitions = query_region_transitions(target_region, last_n_runs)
+                except (sqlite3.Error, OSError) as e:
+                    transitions = None
+                    st.error(f"读取历史记录失败：{str(e)}")
+                if transitions is not None and transitions.empty:
+                    st.info(f"最近{last_n_runs}次运行中没有城市变为{target_region}")
+                elif transitions is not None:
+                    st.dataframe(transitions, use_container_width=True, hide_index=True)
+        
         st.header("图表生成")
         
         if 'df' in st.session_state and not st.session_state['df'].empty:
@@ -636,8 +1218,7 @@ def main():
                 'point1_x': point1_x, 'point1_y': point1_y,
                 'point2_x': point2_x, 'point2_y': point2_y,
                 'float_ratio': float_ratio,
-                'upper_y_threshold': upper_y_threshold, 'upper_slope_ratio': upper_slope_ratio,
-                'lower_y_threshold': lower_y_threshold, 'lower_slope_ratio': lower_slope_ratio,
+                'upper_knees': upper_knees, 'lower_knees': lower_knees,
                 'reasonable_color': reasonable_color,
                 'overpay_color': overpay_color,
                 'undervalue_color': undervalue_color
@@ -649,12 +1230,11 @@ def main():
             with button_col1:
                 # 生成图表按钮
                 if st.button("🎯 生成图表", type="primary", use_container_width=True):
-                    # 优先使用映射结果数据，如果不存在则使用原始数据
-                    if 'mapping_results' in st.session_state and st.session_state['mapping_results'] is not None:
-                        df_for_chart = st.session_state['mapping_results'].copy()
+                    # 映射结果与原始数据保存在同一份会话数据中，绘图时不再复制
+                    df_for_chart = st.session_state['df']
+                    if '映射结果' in df_for_chart.columns:
                         chart_data_source = "映射结果数据"
                     else:
-                        df_for_chart = st.session_state['df'].copy()
                         chart_data_source = "原始数据"
                     
                     # 验证数据
@@ -671,7 +1251,10 @@ def main():
                         
                         try:
                             with st.spinner("正在生成图表..."):
-                                fig = create_scatter_plot(df_for_chart, config)
+                                # 每个会话复用同一个渲染器，只更新发生变化的图层
+                                if 'chart_renderer' not in st.session_state:
+                                    st.session_state['chart_renderer'] = ScatterPlotRenderer()
+                                fig = st.session_state['chart_renderer'].render(df_for_chart, config)
                                 
                                 # 保存图表到session state
                                 st.session_state['current_fig'] = fig
@@ -685,16 +1268,12 @@ def main():
             with button_col2:
                 # 下载图片按钮
                 if 'current_fig' in st.session_state:
-                    # 直接显示下载按钮
-                    img_buffer = io.BytesIO()
-                    st.session_state['current_fig'].savefig(
-                        img_buffer, format='png', dpi=300, bbox_inches='tight'
-                    )
-                    img_buffer.seek(0)
-                    
+                    # 点击下载时才导出高分辨率图片，图表未变化时复用已导出的图片
+                    renderer = st.session_state['chart_renderer']
+                    download_png = lambda: renderer.to_png(dpi=CHART_DOWNLOAD_DPI)
                     st.download_button(
                         label="💾 下载图片",
-                        data=img_buffer.getvalue(),
+                        data=download_png if DEFERRED_DOWNLOAD else download_png(),
                         file_name="城市人效CR值分析图.png",
                         mime="image/png",
                         use_container_width=True,
@@ -704,10 +1283,14 @@ def main():
                     st.button("💾 下载图片", disabled=True, use_container_width=True, help="请先生成图表", type="secondary")
             
             # 显示已生成的图表
+            # 显示缓存的图片，图表未变化时刷新页面不必重新绘制
             if 'current_fig' in st.session_state:
-                st.pyplot(st.session_state['current_fig'])
+                st.image(st.session_state['chart_renderer'].to_png(dpi=CHART_DISPLAY_DPI, tight=False))
         else:
             st.info("请先导入数据")
+    
+    # 会话内存占用
+    st.sidebar.caption(f"当前会话数据内存（数据与图表缓存，不含图形对象）：{format_memory_size(estimate_session_memory(st.session_state))}")
 
 
 def find_free_port(start_port=8501):
@@ -0,0 +1,217 @@
+"""城市人效与CR值分析工具 - 边界线模型回归检查
+
+用随机配置和随机城市检查 app.py 中的分段线性边界线模型：
+
+1. 单拐点配置（旧版参数 upper_y_threshold 等）下，向量化的映射结果
+   与最初逐点计算的判定规则完全一致，包括标准线斜率为负或为0的情况
+   （标准线水平且越过拐点时最初的规则会除以0，此时按水平边界线判定）；
+2. 多拐点配置下，边界线在各节点处连续，经过的Y值依次为各拐点阈值，
+   各区间的斜率依次为标准线斜率乘以对应的比例。
+
+全部检查通过时返回 0，否则输出不一致的配置并返回 1。
+
+用法：
+    python check_boundary_model.py --configs 200 --points 300
+"""
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+from app import (build_boundary_model, calculate_region_metrics, classify_city_region,
+                 evaluate_piecewise_linear, get_boundary_knees)
+
+
+def baseline_classify(x, y, config):
+    """最初版本的逐点判定规则（只支持单个拐点），作为对照"""
+    slope = (config['point2_y'] - config['point1_y']) / (config['point2_x'] - config['point1_x'])
+    intercept = config['point1_y'] - slope * config['point1_x']
+
+    upper_intercept = intercept + config['float_ratio']
+    upper_y = slope * x + upper_intercept
+    if upper_y > config['upper_y_threshold']:
+        new_slope = slope * config['upper_slope_ratio']
+        x_threshold = (config['upper_y_threshold'] - upper_intercept) / slope
+        new_intercept = config['upper_y_threshold'] - new_slope * x_threshold
+        upper_y = new_slope * x + new_intercept
+
+    lower_intercept = intercept - config['float_ratio']
+    lower_y = slope * x + lower_intercept
+    if lower_y < config['lower_y_threshold']:
+        new_slope = slope * config['lower_slope_ratio']
+        x_threshold = (config['lower_y_threshold'] - lower_intercept) / slope
+        new_intercept = config['lower_y_threshold'] - new_slope * x_threshold
+        lower_y = new_slope * x + new_intercept
+
+    if y > upper_y:
+        return "超额支付", upper_y, lower_y
+    elif y < lower_y:
+        return "价值低估", upper_y, lower_y
+    else:
+        return "合理区间", upper_y, lower_y
+
+
+def flat_line_classify(y, config):
+    """标准线水平时的判定规则：上下边界线是标准线上下平移浮动比例的水平线"""
+    upper_y = config['point1_y'] + config['float_ratio']
+    lower_y = config['point1_y'] - config['float_ratio']
+    if y > upper_y:
+        return "超额支付", upper_y, lower_y
+    elif y < lower_y:
+        return "价值低估", upper_y, lower_y
+    else:
+        return "合理区间", upper_y, lower_y
+
+
+def random_base_config(rng):
+    """随机生成基准点和浮动比例，标准线斜率可正可负"""
+    point1_x, point2_x = np.sort(rng.uniform(200, 2500, 2))
+    return {
+        'point1_x': float(point1_x),
+        'point1_y': float(rng.uniform(0.4, 1.6)),
+        'point2_x': float(point2_x),
+        'point2_y': float(rng.uniform(0.4, 1.6)),
+        'float_ratio': float(rng.uniform(0, 0.4)),
+    }
+
+
+def random_single_knee_config(rng):
+    """随机生成旧版单拐点配置"""
+    config = random_base_config(rng)
+    config.update({
+        'upper_y_threshold': float(rng.uniform(0.3, 2.0)),
+        'upper_slope_ratio': float(rng.uniform(0, 2)),
+        'lower_y_threshold': float(rng.uniform(0.0, 1.5)),
+        'lower_slope_ratio': float(rng.uniform(0, 2)),
+    })
+    return config
+
+
+def random_flat_config(rng):
+    """随机生成标准线水平的单拐点配置，拐点可能处处越过或都不越过"""
+    config = random_single_knee_config(rng)
+    config['point2_y'] = config['point1_y']
+    return config
+
+
+def random_multi_knee_config(rng):
+    """随机生成上下边界各 0~4 个拐点的配置"""
+    config = random_base_config(rng)
+    for side in ('upper', 'lower'):
+        count = rng.integers(0, 5)
+        config[f'{side}_knees'] = [
+            (float(t), float(r))
+            for t, r in zip(rng.uniform(-1, 3, count), rng.uniform(0, 2, count))
+        ]
+    return config
+
+
+def check_single_knee(config, rng, points):
+    """与最初的逐点判定规则比较，返回不一致的点数
+
+    离边界线极近（1e-9以内）的点受浮点舍入影响，不计入比较。
+    """
+    x = rng.uniform(0, 3000, points)
+    y = rng.uniform(0, 2.5, points)
+    labels = calculate_region_metrics(pd.DataFrame({'人效': x, 'CR值': y}), config)['映射结果']
+
+    mismatches = 0
+    for xi, yi, label in zip(x, y, labels):
+        try:
+            expected, upper_y, lower_y = baseline_classify(xi, yi, config)
+        except ZeroDivisionError:
+            # 标准线水平且越过拐点时，最初的规则会除以0；
+            # 此时边界线仍是水平线，拐点不改变边界线
+            expected, upper_y, lower_y = flat_line_classify(yi, config)
+        if min(abs(yi - upper_y), abs(yi - lower_y)) < 1e-9:
+            continue
+        if label != expected:
+            mismatches += 1
+
+    # 单点接口与整列计算使用同一套规则
+    if classify_city_region(x[0], y[0], config) != labels.iloc[0]:
+        mismatches += 1
+    return mismatches
+
+
+def check_multi_knee(config, side):
+    """沿边界线向外检查节点的连续性、经过的阈值和各区间斜率，返回问题描述列表"""
+    model = build_boundary_model(config)
+    slope = model['slope']
+    offset = config['float_ratio'] if side == 'upper' else -config['float_ratio']
+    knots_x, knots_y, slopes = model[side]
+    problems = []
+
+    # 各节点左右两侧的值应连续
+    scale = 1 + np.abs(knots_x)
+    left = evaluate_piecewise_linear(knots_x - 1e-6 * scale, model[side])
+    right = evaluate_piecewise_linear(knots_x + 1e-6 * scale, model[side])
+    if np.any(np.abs(left - right) > 4e-6 * scale * np.max(np.abs(slopes)) + 1e-9):
+        problems.append("节点处不连续")
+
+    # 从标准线一侧出发向外，依次经过的Y值和斜率
+    outward = (side == 'upper') == (slope > 0)
+    walk_x = knots_x if outward else knots_x[::-1]
+    walk_y = knots_y if outward else knots_y[::-1]
+    walk_slopes = slopes if outward else slopes[::-1]
+
+    # 出发区间与平移后的标准线重合
+    start_x = walk_x[0] - 100 if outward else walk_x[0] + 100
+    if not np.isclose(evaluate_piecewise_linear(start_x, model[side]),
+                      slope * start_x + model['intercept'] + offset):
+        problems.append("起始区间不是平移后的标准线")
+
+    expected_slopes = [slope]
+    expected_y = []
+    for threshold, ratio in get_boundary_knees(config, side):
+        if expected_slopes[-1] == 0:
+            break
+        expected_y.append(threshold)
+        expected_slopes.append(slope * ratio)
+    if expected_y:
+        if not np.allclose(walk_y, expected_y):
+            problems.append(f"节点Y值 {walk_y} 与拐点阈值 {expected_y} 不一致")
+        if not np.allclose(walk_slopes, expected_slopes):
+            problems.append(f"区间斜率 {walk_slopes} 与预期 {expected_slopes} 不一致")
+    elif not np.allclose(slopes, slope):
+        problems.append("没有拐点时斜率应与标准线相同")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="边界线模型回归检查")
+    parser.add_argument('--configs', type=int, default=200, help="每类检查的随机配置数量")
+    parser.add_argument('--points', type=int, default=300, help="单拐点检查中每个配置的随机城市数量")
+    parser.add_argument('--seed', type=int, default=0, help="随机数种子")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    failures = []
+
+    for _ in range(args.configs):
+        config = random_single_knee_config(rng)
+        mismatches = check_single_knee(config, rng, args.points)
+        if mismatches:
+            failures.append((config, f"{mismatches} 个点的映射结果与逐点判定不一致"))
+
+    for _ in range(args.configs):
+        config = random_flat_config(rng)
+        mismatches = check_single_knee(config, rng, args.points)
+        if mismatches:
+            failures.append((config, f"标准线水平时 {mismatches} 个点的映射结果不一致"))
+
+    for _ in range(args.configs):
+        config = random_multi_knee_config(rng)
+        for side in ('upper', 'lower'):
+            failures.extend((config, f"{side}：{problem}") for problem in check_multi_knee(config, side))
+
+    for config, problem in failures[:10]:
+        print(f"❌ {problem}\n   配置：{config}")
+    print(f"单拐点配置 {args.configs} 个，水平标准线配置 {args.configs} 个，"
+          f"多拐点配置 {args.configs} 个，发现问题 {len(failures)} 个")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
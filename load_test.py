@@ -0,0 +1,283 @@
+"""城市人效与CR值分析工具 - 多会话并发压力测试
+
+基于 Streamlit 的进程内应用测试工具（streamlit.testing.v1.AppTest），
+在同一个进程中模拟多位分析师同时使用 app.py：
+打开页面 → 上传文件 → 计算映射结果 → 生成图表 → 调整参数并重新生成 → 下载图片。
+
+统计每类交互的 p50/p95/p99 延迟、吞吐量，以及运行期间进程的内存占用（RSS）。
+全部在本机进程内完成，不启动服务器也不访问网络。
+
+需要 Streamlit 1.56.0 或更高版本（AppTest 从该版本开始支持文件上传）。
+
+用法：
+    python load_test.py --sessions 30 --concurrency 30 --rows 200
+"""
+import argparse
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import streamlit
+from streamlit.testing.v1 import AppTest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+# AppTest 从该版本开始支持文件上传（at.file_uploader）
+MIN_STREAMLIT_VERSION = '1.56.0'
+
+# 交互步骤，按会话中的执行顺序排列
+STEPS = ['打开页面', '上传文件', '计算映射结果', '生成图表', '调整参数', '重新生成图表', '下载图片']
+
+
+def install_shared_server_state():
+    """让并发运行的 AppTest 像同一个服务器上的多个会话一样共享服务器状态
+
+    AppTest 每次运行结束都会把全局的 Runtime._instance 置为 None，
+    多个会话并发运行时，其他会话的脚本会因此找不到 Runtime。
+    这里记住最近一次创建的 Runtime，在被置空时继续返回它；
+    所有会话共用一个 ScriptCache，与真实服务器一样只编译一次脚本
+    （并发编译同一脚本在部分Python版本上会出错）；
+    同时固定 global.appTest 配置，避免并发的配置恢复互相覆盖。
+
+    这些都是 Streamlit 的内部接口，版本不兼容时抛出 ImportError 或 AttributeError。
+    返回一个函数，调用后恢复被替换的内部接口和配置。
+    """
+    from streamlit import config as st_config
+    from streamlit import logger as st_logger
+    from streamlit.runtime.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import local_script_runner
+
+    original_instance = Runtime.__dict__['instance']
+    original_exists = Runtime.__dict__['exists']
+    original_script_cache = local_script_runner.ScriptCache
+    original_app_test = st_config.get_option('global.appTest')
+
+    last_instance = [None]
+    shared_script_cache = ScriptCache()
+
+    def instance(cls):
+        if cls._instance is not None:
+            last_instance[0] = cls._instance
+        if last_instance[0] is None:
+            raise RuntimeError("Runtime hasn't been created!")
+        return last_instance[0]
+
+    def exists(cls):
+        return cls._instance is not None or last_instance[0] is not None
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(exists)
+    local_script_runner.ScriptCache = lambda: shared_script_cache
+    st_config.set_option('global.appTest', True)
+    # 压测输出只保留统计结果
+    st_logger.set_log_level('error')
+
+    def restore():
+        Runtime.instance = original_instance
+        Runtime.exists = original_exists
+        local_script_runner.ScriptCache = original_script_cache
+        st_config.set_option('global.appTest', original_app_test)
+
+    return restore
+
+
+def read_rss_mb():
+    """读取当前进程的常驻内存（MB）"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        # 非Linux系统只能取得峰值内存
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss / 1024 / 1024 if sys.platform == 'darwin' else max_rss / 1024
+
+
+class RssSampler(threading.Thread):
+    """后台线程，按固定间隔记录进程内存"""
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = []
+        self.stop_event = threading.Event()
+        self.start_time = time.perf_counter()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.samples.append((time.perf_counter() - self.start_time, read_rss_mb()))
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        self.samples.append((time.perf_counter() - self.start_time, read_rss_mb()))
+
+
+def make_upload_file(rows, seed):
+    """生成一份随机的城市数据CSV，返回上传所需的 (文件名, 内容, MIME类型)"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        '城市': [f'城市{i}' for i in range(rows)],
+        '人效': rng.uniform(300, 2300, rows).round(2),
+        'CR值': rng.uniform(0.5, 1.5, rows).round(2),
+        '离职率': rng.uniform(0, 0.2, rows).round(3),
+    })
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False)
+    return (f'城市数据_{seed}.csv', buffer.getvalue().encode('utf-8-sig'), 'text/csv')
+
+
+def find_button(at, label):
+    """按标签查找按钮"""
+    for button in at.button:
+        if button.label == label:
+            return button
+    raise LookupError(f"未找到按钮：{label}")
+
+
+def check_run(at):
+    """脚本运行出现异常或错误提示时抛出异常"""
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    errors = [e.value for e in at.error if '字体' not in e.value]
+    if errors:
+        raise RuntimeError(errors[0])
+
+
+def run_session(session_id, rows, timeout):
+    """模拟一位分析师的完整操作流程，返回每一步的耗时（秒）"""
+    timings = []
+
+    def timed(step, action):
+        start = time.perf_counter()
+        action()
+        check_run(at)
+        timings.append((step, time.perf_counter() - start))
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    upload = make_upload_file(rows, session_id)
+
+    timed('打开页面', lambda: at.run())
+    timed('上传文件', lambda: at.file_uploader[0].set_value(upload).run())
+    timed('计算映射结果', lambda: find_button(at, '🔍 计算映射结果').click().run())
+    timed('生成图表', lambda: find_button(at, '🎯 生成图表').click().run())
+
+    float_ratio = next(w for w in at.sidebar.number_input if w.label == '浮动比例')
+    timed('调整参数', lambda: float_ratio.set_value(0.2).run())
+    timed('重新生成图表', lambda: find_button(at, '🎯 生成图表').click().run())
+    timed('下载图片', lambda: at.download_button[0].click().run())
+
+    return timings
+
+
+def percentile_row(name, values):
+    """格式化一行延迟统计（毫秒）"""
+    values_ms = np.asarray(values) * 1000
+    p50, p95, p99 = np.percentile(values_ms, [50, 95, 99])
+    return f"{name:<10}{len(values_ms):>6}{p50:>10.0f}{p95:>10.0f}{p99:>10.0f}{values_ms.max():>10.0f}"
+
+
+def print_report(results, failures, wall_time, rss_samples, sessions):
+    """输出延迟、吞吐量和内存统计"""
+    all_timings = [t for timings in results for t in timings]
+
+    print()
+    print(f"会话数：{sessions}，成功：{len(results)}，失败：{len(failures)}，总耗时：{wall_time:.1f} 秒")
+    for session_id, error in failures[:5]:
+        print(f"  会话 {session_id} 失败：{error}")
+
+    if all_timings:
+        print()
+        print("交互延迟（毫秒）")
+        print(f"{'步骤':<10}{'次数':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+        for step in STEPS:
+            values = [elapsed for name, elapsed in all_timings if name == step]
+            if values:
+                print(percentile_row(step, values))
+        print(percentile_row('全部交互', [elapsed for _, elapsed in all_timings]))
+
+        print()
+        print(f"吞吐量：{len(all_timings) / wall_time:.2f} 次交互/秒，{len(results) / wall_time:.2f} 个会话/秒")
+
+    print()
+    print("进程内存（RSS）")
+    print(f"{'时间(秒)':<10}{'RSS(MB)':>10}")
+    for elapsed, rss in rss_samples:
+        print(f"{elapsed:<10.1f}{rss:>10.1f}")
+    print(f"峰值：{max(rss for _, rss in rss_samples):.1f} MB，"
+          f"增长：{rss_samples[-1][1] - rss_samples[0][1]:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="城市人效与CR值分析工具并发压力测试")
+    parser.add_argument('--sessions', type=int, default=30, help="模拟的会话总数")
+    parser.add_argument('--concurrency', type=int, default=30, help="同时运行的会话数")
+    parser.add_argument('--rows', type=int, default=200, help="每个会话上传的城市数量")
+    parser.add_argument('--timeout', type=float, default=120, help="单次交互的超时时间（秒）")
+    parser.add_argument('--rss-interval', type=float, default=1.0, help="内存采样间隔（秒）")
+    args = parser.parse_args()
+
+    if not hasattr(AppTest, 'file_uploader'):
+        print(f"❌ 错误：当前Streamlit {streamlit.__version__} 的AppTest不支持文件上传，"
+              f"请升级到 {MIN_STREAMLIT_VERSION} 或更高版本")
+        return 1
+
+    try:
+        restore_server_state = install_shared_server_state()
+    except (ImportError, AttributeError, KeyError) as e:
+        print(f"❌ 错误：当前Streamlit {streamlit.__version__} 的内部接口不兼容（{e}），"
+              f"请使用 {MIN_STREAMLIT_VERSION} 或更高版本")
+        return 1
+
+    # 历史记录写入临时数据库，不影响本机的正式历史记录
+    history_dir = tempfile.mkdtemp(prefix='cr_chart_load_test_')
+    original_history_db = os.environ.get('CR_CHART_HISTORY_DB')
+    os.environ['CR_CHART_HISTORY_DB'] = os.path.join(history_dir, 'history.db')
+    try:
+        # 预热一个会话：加载模块、字体和共享的Runtime，不计入统计
+        print("正在预热...")
+        run_session(args.sessions, args.rows, args.timeout)
+
+        print(f"正在运行 {args.sessions} 个会话（并发 {args.concurrency}）...")
+        sampler = RssSampler(args.rss_interval)
+        sampler.start()
+
+        results = []
+        failures = []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = {
+                executor.submit(run_session, session_id, args.rows, args.timeout): session_id
+                for session_id in range(args.sessions)
+            }
+            for future, session_id in futures.items():
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    failures.append((session_id, e))
+        wall_time = time.perf_counter() - start
+        sampler.stop()
+
+        print_report(results, failures, wall_time, sampler.samples, args.sessions)
+    finally:
+        restore_server_state()
+        if original_history_db is None:
+            os.environ.pop('CR_CHART_HISTORY_DB', None)
+        else:
+            os.environ['CR_CHART_HISTORY_DB'] = original_history_db
+        shutil.rmtree(history_dir, ignore_errors=True)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())